@@ -4,6 +4,7 @@ import glob
 import csv
 import shutil
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from alive_progress import alive_bar
 sys.path.append('..')
 from utils import foldseek
@@ -18,11 +19,17 @@ def main(pdb_path, outname, filts):
         writer = csv.writer(file)
         writer.writerow(["pdb", "chain", "aa_seq", "struc_seq"])
     
-        with alive_bar(len(pdbs), bar="fish") as bar:
-            for pdb in pdbs:
-                raw_data = foldseek.get_struc_seq(
-                    "../bin/foldseek",
-                    pdb)
+        # Run foldseek on all the pdbs in parallel (each process with its own
+        # temporary files) and write the results in the original order
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor, \
+             alive_bar(len(pdbs), bar="fish") as bar:
+            futures = [executor.submit(foldseek.get_struc_seq,
+                                       "../bin/foldseek",
+                                       pdb,
+                                       process_id=i)
+                       for i, pdb in enumerate(pdbs)]
+            for pdb, future in zip(pdbs, futures):
+                raw_data = future.result()
                 for chain in raw_data.keys():
                     aa_seq = raw_data[chain][0]
                     struc_seq = raw_data[chain][1]
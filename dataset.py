@@ -1,51 +1,118 @@
+import os
 import torch
 import random
 import numpy as np
 import matplotlib.pyplot as plt
-from torch.utils.data import random_split, Dataset, Subset, DataLoader
+from functools import partial
+from torch.utils.data import random_split, Dataset, Subset, DataLoader, Sampler, default_collate
 
 
 class SeqsDataset(Dataset):
-    def __init__(self, aa_seqs, struc_seqs):
+    def __init__(self, aa_seqs, struc_seqs,
+                 tokenizer_aa_seqs,
+                 tokenizer_struc_seqs,
+                 max_len=1024):
         self.aa_seqs = aa_seqs
         self.struc_seqs = struc_seqs
 
+        # Tokenize all the sequences once instead of on every batch
+        # Vocabularies are small, so ids are stored as int32 and masks as bool
+        encoded_aa_seqs = tokenizer_aa_seqs(aa_seqs, max_len=max_len, truncation=True)
+        encoded_struc_seqs = tokenizer_struc_seqs(struc_seqs, max_len=max_len, truncation=True)
+        self.aa_ids = encoded_aa_seqs['input_ids'].to(torch.int32)
+        self.aa_mask = encoded_aa_seqs['attention_mask'].bool()
+        self.struc_ids = encoded_struc_seqs['input_ids'].to(torch.int32)
+        self.struc_mask = encoded_struc_seqs['attention_mask'].bool()
+
     def __len__(self):
         return len(self.aa_seqs)
 
     def __getitem__(self, idx):
-        # Return protein and structural sequence pairs without tokenizing
-        aa_seq = self.aa_seqs[idx]
-        struc_seq = self.struc_seqs[idx]
-        return aa_seq, struc_seq
+        # Return the pretokenized protein and structural sequence pairs
+        return {'aa_ids': self.aa_ids[idx],
+                'aa_mask': self.aa_mask[idx],
+                'struc_ids': self.struc_ids[idx],
+                'struc_mask': self.struc_mask[idx]}
+
+class LengthBucketSampler(Sampler):
+    def __init__(self, num_samples, batch_size, num_replicas=1, rank=0, seed=1234):
+        """
+        Args:
+            num_samples (int): Number of samples of the dataset, which must
+                               be sorted by sequence length.
+            batch_size (int): Batch size of each GPU.
+            num_replicas (int): Number of GPUs, each bucket of consecutive
+                                samples holds one batch for every GPU.
+            rank (int): GPU of this process, only its batch of every
+                        bucket is sampled.
+            seed (int): Seed of the shuffling, it must be the same on all
+                        GPUs so they all iterate the buckets in the same order.
+        """
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.bucket_size = batch_size * num_replicas
+        self.seed = seed
+        self.epoch = 0
+
+        # Every GPU takes its own consecutive slice of each bucket. The last
+        # (incomplete) bucket is padded with its own samples up to a multiple
+        # of num_replicas, so all the GPUs get the same number of batches
+        self.batches = []
+        for start in range(0, num_samples, self.bucket_size):
+            bucket = list(range(start, min(start + self.bucket_size, num_samples)))
+            padding = -len(bucket) % num_replicas
+            bucket += (bucket * padding)[:padding]
+            rank_size = len(bucket) // num_replicas
+            self.batches.append(bucket[rank * rank_size:(rank + 1) * rank_size])
+
+    def __len__(self):
+        return sum(len(batch) for batch in self.batches)
+
+    def __iter__(self):
+        order = self.get_order(self.epoch)
+        self.epoch += 1
+        return iter(order)
+
+    def get_order(self, epoch):
+        # Sequences of similar length stay in the same batch (and hence are
+        # padded to a similar length) but the full buckets are shuffled every
+        # epoch. The incomplete last batch always goes last, otherwise the
+        # DataLoader would merge it with the start of the following one
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+
+        num_full_buckets = self.num_samples // self.bucket_size
+        batch_idxs = torch.randperm(num_full_buckets, generator=generator).tolist()
+        batch_idxs += list(range(num_full_buckets, len(self.batches)))
+        return [idx for batch_idx in batch_idxs for idx in self.batches[batch_idx]]
+
+def trim_padding(ids, mask):
+    # Sequences are padded to the longest of the whole dataset, remove the
+    # padding columns shared by all the sequences of the batch
+    # (attention masks are True on padding tokens)
+    length = int((~mask).sum(dim=1).max())
+    return ids[:, :length], mask[:, :length]
 
 def collate_fn(batch,
-               tokenizer_aa_seqs,
                tokenizer_struc_seqs,
-               masking_ratio=None,
-               max_len=1024):
+               masking_ratio=None):
     
-    aa_seqs = [item[0] for item in batch]
-    struc_seqs = [item[1] for item in batch]
+    batch = default_collate(batch)
 
-    # Tokenize the protein sequences (encoder input)
-    encoded_aa_seqs = tokenizer_aa_seqs(aa_seqs, max_len=max_len, padding=True, truncation=True)
+    # Protein sequences (encoder input)
+    encoder_input_ids, encoder_attention_mask = trim_padding(batch['aa_ids'], batch['aa_mask'])
 
-    # Tokenize the structural sequences (decoder input/output)
-    encoded_struc_seqs = tokenizer_struc_seqs(struc_seqs, max_len=max_len, padding=True, truncation=True)
+    # Structural sequences (decoder input/output)
+    struc_ids, struc_mask = trim_padding(batch['struc_ids'], batch['struc_mask'])
+    encoded_struc_seqs = {'input_ids': struc_ids, 'attention_mask': struc_mask}
 
     if masking_ratio:
-        mask_id = tokenizer_struc_seqs.mask_id
-        masked_decoder_input_ids = masking_struc_seqs_ids(encoded_struc_seqs['input_ids'],
-                                                          tokenizer_struc_seqs,
-                                                          masking_ratio=masking_ratio)
-        decoder_input_ids = masked_decoder_input_ids
-        # Get masked labels
-        masked_labels = encoded_struc_seqs['input_ids'].clone()
-        mask = masked_decoder_input_ids.clone()
-        mask = (mask == mask_id)
-        masked_labels[~mask]=-100
-        labels = masked_labels
+        # Get masked decoder inputs and masked labels
+        decoder_input_ids, labels = masking_struc_seqs_ids(encoded_struc_seqs['input_ids'],
+                                                           tokenizer_struc_seqs,
+                                                           masking_ratio=masking_ratio)
     else:
         decoder_input_ids = encoded_struc_seqs['input_ids']
         labels = decoder_input_ids
@@ -58,8 +125,8 @@ def collate_fn(batch,
     labels = labels[:, 1:]
 
     return {
-        'encoder_input_ids': encoded_aa_seqs['input_ids'],
-        'encoder_attention_mask': encoded_aa_seqs['attention_mask'],
+        'encoder_input_ids': encoder_input_ids,
+        'encoder_attention_mask': encoder_attention_mask,
         'decoder_input_ids': decoder_input_ids,
         'decoder_attention_mask': decoder_attention_mask,
         'labels':  labels
@@ -72,24 +139,34 @@ def masking_struc_seqs_ids(decoder_input_ids,
     mask_token_id = tokenizer_struc_seqs.mask_id
     eos_token_id = tokenizer_struc_seqs.eos_id
 
-    masked_decoder_input_ids = decoder_input_ids.clone()
-    for input_id in masked_decoder_input_ids:
-        end_idx = (input_id == eos_token_id).nonzero(as_tuple=True)[0].item()
-        seq_len = end_idx - 1
-        num_elements_to_mask = max(1, int(seq_len * masking_ratio))
-        idxs_to_mask = torch.randperm(seq_len)[:num_elements_to_mask] + 1
-        input_id[idxs_to_mask] = mask_token_id
+    batch_size, seq_len = decoder_input_ids.shape
+    positions = torch.arange(seq_len, device=decoder_input_ids.device)
 
-    return masked_decoder_input_ids
+    # Maskable positions lie between <cls> and <eos> of each sequence
+    end_idx = (decoder_input_ids == eos_token_id).int().argmax(dim=1)
+    maskable = (positions[None, :] >= 1) & (positions[None, :] < end_idx[:, None])
+    num_elements_to_mask = ((end_idx - 1).float() * masking_ratio).long().clamp(min=1)
+
+    # Rank the maskable positions of each row in a random order (the
+    # others go last) and mask the first num_elements_to_mask of them,
+    # all in batched calls and without reading anything back to the host
+    rnd = torch.rand(batch_size, seq_len, device=decoder_input_ids.device)
+    rnd.masked_fill_(~maskable, float('inf'))
+    ranks = rnd.argsort(dim=1).argsort(dim=1)
+    mask = (ranks < num_elements_to_mask[:, None]) & maskable
+
+    masked_decoder_input_ids = decoder_input_ids.masked_fill(mask, mask_token_id)
+    # Only the masked positions contribute to the loss
+    masked_labels = decoder_input_ids.masked_fill(~mask, -100)
+
+    return masked_decoder_input_ids, masked_labels
 
 def prepare_data(dataset,
                  test_split,
                  masking_ratio,
                  batch_size,
-                 tokenizer_aa_seqs,
                  tokenizer_struc_seqs,
                  fabric,
-                 max_len,
                  verbose):
 
     # Split the dataset into train and validation randomly
@@ -101,32 +178,29 @@ def prepare_data(dataset,
     if verbose >= 2 and fabric.is_global_zero:
         fabric.print('Plotting the distribution of the unsorted lengths sequences...')
         plt.figure()
-        train_prots_lengths = [len(prot[0]) for prot in train_dataset]
-        test_prots_lengths = [len(prot[0]) for prot in test_dataset]
+        train_prots_lengths = [len(dataset.aa_seqs[idx]) for idx in train_dataset.indices]
+        test_prots_lengths = [len(dataset.aa_seqs[idx]) for idx in test_dataset.indices]
         plt.hist(train_prots_lengths, label='train proteins', alpha=0.5)
         plt.hist(test_prots_lengths, label='test proteins', alpha=0.5)
         plt.legend()
         plt.savefig('hist_train_test_prots_unsorted.pdf')
     
     # Sort the datasets based on the lengths of the sequences
-    idxs_train = list(range(len(train_dataset)))
-    idxs_test = list(range(len(test_dataset)))
-    
-    train_lengths = [(idx, len(train_dataset[idx][0]) + len(train_dataset[idx][1])) for idx in idxs_train]
-    test_lengths = [(idx, len(test_dataset[idx][0]) + len(test_dataset[idx][1])) for idx in idxs_test]
+    train_lengths = [(idx, len(dataset.aa_seqs[idx]) + len(dataset.struc_seqs[idx])) for idx in train_dataset.indices]
+    test_lengths = [(idx, len(dataset.aa_seqs[idx]) + len(dataset.struc_seqs[idx])) for idx in test_dataset.indices]
     sorted_train_indices = [idx for idx, length in sorted(train_lengths, key=lambda x: x[1])]
     sorted_test_indices = [idx for idx, length in sorted(test_lengths, key=lambda x: x[1])]
 
     # Create the sorted datasets using the sorted indices
-    train_dataset = Subset(train_dataset, sorted_train_indices)
-    test_dataset = Subset(test_dataset, sorted_test_indices)
+    train_dataset = Subset(dataset, sorted_train_indices)
+    test_dataset = Subset(dataset, sorted_test_indices)
 
     # Plot the distribution of the sequence lengths of the train and validation datasets
     if verbose >= 2 and fabric.is_global_zero:
         fabric.print('Plotting the distribution of the sorted lengths sequences...')
         plt.figure()
-        train_prots_lenghts = [len(train_dataset[idx][0]) for idx in idxs_train]
-        test_prots_lenghts = [len(test_dataset[idx][0]) for idx in idxs_test]
+        train_prots_lenghts = [len(dataset.aa_seqs[idx]) for idx in train_dataset.indices]
+        test_prots_lenghts = [len(dataset.aa_seqs[idx]) for idx in test_dataset.indices]
         plt.hist(train_prots_lenghts, label='train proteins', alpha=0.5)
         plt.hist(test_prots_lenghts, label='test proteins', alpha=0.5)
         plt.legend()
@@ -137,20 +211,38 @@ def prepare_data(dataset,
         fabric.print('- Total amount of structres in testing dataset %d' % len(test_dataset))
 
     # Load DataLoader
+    # Masking runs inside collate_fn, so spread it over worker
+    # processes (partial instead of lambda so it can be pickled)
+    # The CPUs of each GPU are split between both loaders since their
+    # workers are kept alive for the whole run (evaluation takes the smaller
+    # share as it runs on fewer batches)
+    cpus_per_gpu = max(2, (os.cpu_count() or 2) // fabric.world_size)
+    test_num_workers = max(1, cpus_per_gpu // 4)
+    train_num_workers = cpus_per_gpu - test_num_workers
+    # The sampler already yields only this GPU batches (each bucket holds
+    # one batch for every GPU), so Fabric must not replace it
+    train_sampler = LengthBucketSampler(len(train_dataset),
+                                        batch_size=batch_size,
+                                        num_replicas=fabric.world_size,
+                                        rank=fabric.global_rank)
     train_loader =  DataLoader(train_dataset,
                                batch_size=batch_size,
-                               shuffle=False,
-                               collate_fn=lambda batch: collate_fn(batch,
-                                                                   tokenizer_aa_seqs,
-                                                                   tokenizer_struc_seqs,
-                                                                   masking_ratio=masking_ratio,
-                                                                   max_len=max_len))
+                               sampler=train_sampler,
+                               num_workers=train_num_workers,
+                               persistent_workers=True,
+                               prefetch_factor=4,
+                               pin_memory=True,
+                               collate_fn=partial(collate_fn,
+                                                  tokenizer_struc_seqs=tokenizer_struc_seqs,
+                                                  masking_ratio=masking_ratio))
 
     test_loader =  DataLoader(test_dataset,
                               batch_size=batch_size,
                               shuffle=False,
-                              collate_fn=lambda batch: collate_fn(batch,
-                                                                  tokenizer_aa_seqs,
-                                                                  tokenizer_struc_seqs,
-                                                                  max_len=max_len))
+                              num_workers=test_num_workers,
+                              persistent_workers=True,
+                              prefetch_factor=4,
+                              pin_memory=True,
+                              collate_fn=partial(collate_fn,
+                                                 tokenizer_struc_seqs=tokenizer_struc_seqs))
     return train_loader, test_loader
@@ -13,12 +13,15 @@ json_dictionary = {
     "epochs": 10,
     "test_split": 0.20,
     "masking_ratio": 0.15,
-    "epsilon": 1e-8,
+    "accumulation_steps": 1,
     "verbose": 1,
     "max_len": 1024,
     "num_gpus": 4,
     "parallel_strategy": "ddp",
+    "precision": "bf16-mixed",
     "draw_model": False,
+    "compile_model": False,
+    "remove_padding": False,
     "early_stopping_patience": 5,
     "early_stopping_delta": 0.001
 }
@@ -31,7 +31,7 @@ class PositionalEncoding(nn.Module):
         super(PositionalEncoding, self).__init__()
        
         # max_len + 2 to account for aa_max_len + cls + eos
-        self.pe = torch.zeros(max_len + 2, dim_model)
+        pe = torch.zeros(max_len + 2, dim_model)
         
         # Positional encoding tensor from 0 to the max length of the sequence in 1D
         pos = torch.arange(0, max_len + 2, dtype=torch.float).unsqueeze(1)
@@ -39,14 +39,16 @@ class PositionalEncoding(nn.Module):
         div_term = torch.exp(torch.arange(0, dim_model, 2).float() * (-torch.log(torch.tensor(10000.0)) / dim_model))
         
         # Applies sin function to all even indices
-        self.pe[:, 0::2] = torch.sin(pos * div_term)
+        pe[:, 0::2] = torch.sin(pos * div_term)
         # Applies cos function to all odd indices
-        self.pe[:, 1::2] = torch.cos(pos * div_term)
+        pe[:, 1::2] = torch.cos(pos * div_term)
         
-        self.pe = self.pe.unsqueeze(0)
+        # Registered as a (non persistent) buffer so it is moved to the
+        # device with the model instead of being copied on every forward
+        self.register_buffer('pe', pe.unsqueeze(0), persistent=False)
 
     def forward(self, x):
-        x = x + self.pe[:, :x.size(1), :].to(x.device)
+        x = x + self.pe[:, :x.size(1), :]
         return x
 
 
@@ -62,6 +64,8 @@ class Encoder(nn.Module):
         self.embedding_encoder = nn.Embedding(input_dim, dim_model)
         self.pos_encoder = PositionalEncoding(dim_model, max_len)
         
+        # nn.MultiheadAttention already dispatches to
+        # F.scaled_dot_product_attention (flash/memory efficient kernels)
         encoder_layer = nn.TransformerEncoderLayer(dim_model,
                                                    num_heads,
                                                    dim_feedforward=ff_hidden_layer,
@@ -117,9 +121,49 @@ class Encoder(nn.Module):
         return memory
 
 
+class UnpaddedTransformerDecoderLayer(nn.TransformerDecoderLayer):
+    '''
+    TransformerDecoderLayer whose feed-forward block only runs on the non
+    padding tokens: they are gathered before the two linear layers and
+    scattered back afterwards (padding positions get a zero update).
+    The indices of the non padding tokens (ff_idxs) are computed once by
+    the Decoder and passed to every layer.
+    '''
+    def forward(self, tgt, memory, tgt_mask=None, memory_mask=None,
+                tgt_key_padding_mask=None, memory_key_padding_mask=None,
+                tgt_is_causal=False, memory_is_causal=False,
+                ff_idxs=None):
+        
+        # Same as nn.TransformerDecoderLayer.forward with the unpadded
+        # feed-forward block
+        x = tgt
+        if self.norm_first:
+            x = x + self._sa_block(self.norm1(x), tgt_mask, tgt_key_padding_mask, tgt_is_causal)
+            x = x + self._mha_block(self.norm2(x), memory, memory_mask, memory_key_padding_mask, memory_is_causal)
+            x = x + self._unpadded_ff_block(self.norm3(x), ff_idxs)
+        else:
+            x = self.norm1(x + self._sa_block(x, tgt_mask, tgt_key_padding_mask, tgt_is_causal))
+            x = self.norm2(x + self._mha_block(x, memory, memory_mask, memory_key_padding_mask, memory_is_causal))
+            x = self.norm3(x + self._unpadded_ff_block(x, ff_idxs))
+        return x
+
+    def _unpadded_ff_block(self, x, ff_idxs):
+        if ff_idxs is None:
+            return self._ff_block(x)
+
+        # x is (seq_len, batch, dim_model), ff_idxs index its flattened rows
+        flat_x = x.reshape(-1, x.size(-1))
+        ff_output = self._ff_block(flat_x.index_select(0, ff_idxs))
+        
+        output = ff_output.new_zeros(flat_x.shape)
+        output.index_copy_(0, ff_idxs, ff_output)
+        return output.view(x.shape)
+
+
 class Decoder(nn.Module):
     def __init__(self, output_dim, max_len, dim_model, num_heads,
-                 num_layers, ff_hidden_layer, dropout, verbose=False):
+                 num_layers, ff_hidden_layer, dropout, verbose=False,
+                 remove_padding=False):
         
         super(Decoder, self).__init__()
         
@@ -128,11 +172,16 @@ class Decoder(nn.Module):
         self.embedding_decoder = nn.Embedding(output_dim, dim_model)
         self.pos_decoder = PositionalEncoding(dim_model, max_len)
 
-        decoder_layer = nn.TransformerDecoderLayer(dim_model,
-                                                   num_heads,
-                                                   dim_feedforward=ff_hidden_layer,
-                                                   dropout=dropout,
-                                                   batch_first=False)
+        # Skipping the padding in the feed-forward layers only pays off when
+        # padding is a large fraction of the batch
+        self.remove_padding = remove_padding
+        decoder_layer_class = UnpaddedTransformerDecoderLayer if remove_padding \
+                              else nn.TransformerDecoderLayer
+        decoder_layer = decoder_layer_class(dim_model,
+                                            num_heads,
+                                            dim_feedforward=ff_hidden_layer,
+                                            dropout=dropout,
+                                            batch_first=False)
 
         self.decoder = nn.TransformerDecoder(decoder_layer, num_layers)
         self.fc_out = nn.Linear(dim_model, output_dim)
@@ -175,12 +224,27 @@ class Decoder(nn.Module):
             decoder_padding_mask = decoder_padding_mask.bool()
         if torch.is_tensor(memory_key_padding_mask):
             memory_key_padding_mask = memory_key_padding_mask.bool()
-        output = self.decoder(decoder_emb.transpose(0,1),
-                              memory,
-                              tgt_mask=decoder_mask,
-                              memory_mask=memory_mask,
-                              tgt_key_padding_mask=decoder_padding_mask,
-                              memory_key_padding_mask=memory_key_padding_mask)
+        if self.remove_padding and decoder_padding_mask is not None:
+            # Rows of the flattened (seq_len * batch, dim_model) decoder states
+            # that are not padding, computed once for all the layers (nonzero
+            # syncs with the host and breaks the graph if the model is compiled)
+            ff_idxs = (~decoder_padding_mask.t()).reshape(-1).nonzero(as_tuple=True)[0]
+            output = decoder_emb.transpose(0,1)
+            for layer in self.decoder.layers:
+                output = layer(output,
+                               memory,
+                               tgt_mask=decoder_mask,
+                               memory_mask=memory_mask,
+                               tgt_key_padding_mask=decoder_padding_mask,
+                               memory_key_padding_mask=memory_key_padding_mask,
+                               ff_idxs=ff_idxs)
+        else:
+            output = self.decoder(decoder_emb.transpose(0,1),
+                                  memory,
+                                  tgt_mask=decoder_mask,
+                                  memory_mask=memory_mask,
+                                  tgt_key_padding_mask=decoder_padding_mask,
+                                  memory_key_padding_mask=memory_key_padding_mask)
 
         if self.verbose > 1:
             print(f"\t -decoder_output shape: {output.shape}")
@@ -196,7 +260,8 @@ class Decoder(nn.Module):
 
 class TransformerModel(nn.Module):
     def __init__(self, input_dim, output_dim, max_len, dim_model, num_heads,
-                 num_layers, ff_hidden_layer, dropout, verbose=0):
+                 num_layers, ff_hidden_layer, dropout, verbose=0,
+                 remove_padding=False):
         
         super(TransformerModel, self).__init__()
 
@@ -208,7 +273,8 @@ class TransformerModel(nn.Module):
         self.decoder_block = Decoder(output_dim, max_len,
                                      dim_model, num_heads,
                                      num_layers, ff_hidden_layer,
-                                     dropout, verbose)
+                                     dropout, verbose,
+                                     remove_padding=remove_padding)
         self.verbose = verbose
     
     def forward(self, encoder_input, decoder_input,
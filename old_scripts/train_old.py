@@ -46,10 +46,10 @@ def collate_fn(batch, tokenizer_aa_seqs, tokenizer_struc_seqs, max_len=1024):
     struc_seqs = [item[1] for item in batch]
 
     # Tokenize the protein sequences (encoder input)
-    encoded_aa_seqs = tokenizer_aa_seqs(aa_seqs, max_len=max_len, padding=True, truncation=True)
+    encoded_aa_seqs = tokenizer_aa_seqs(aa_seqs, max_len=max_len, truncation=True)
 
     # Tokenize the structural sequences (decoder input/output)
-    encoded_struc_seqs = tokenizer_struc_seqs(struc_seqs, max_len=max_len, padding=True, truncation=True)
+    encoded_struc_seqs = tokenizer_struc_seqs(struc_seqs, max_len=max_len, truncation=True)
 
     return {
         'encoder_input_ids': encoded_aa_seqs['input_ids'],
@@ -1,5 +1,6 @@
 import torch
 import itertools
+import numpy as np
 from Bio import SeqIO
 from utils.foldseek import get_struc_seq
 # from SaProt.utils.foldseek_util import get_struc_seq
@@ -10,6 +11,34 @@ foldseek_struc_vocab = "pynwrqhgdlvtmfsaeikc"
 
 foldseek_path = '/gpfs/projects/bsc72/isoul/ProtSeq2StrucAlpha/bin/foldseek'
 
+def build_lut(vocab, token2id, unk_id):
+    # ASCII code -> token id lookup table, unknown characters map to <unk>
+    lut = np.full(256, unk_id, dtype=np.int64)
+    for token in vocab:
+        lut[ord(token)] = token2id[token]
+    return lut
+
+def encode_seqs(seqs, lut, cls_id, eos_id, pad_id,
+                max_len=1024, truncation=True):
+    # Truncation startegy for max_length (not longest)
+    if truncation:
+        seqs = [seq[:max_len] for seq in seqs]
+
+    # Padding strategy longest (always applied, as the ids are returned as
+    # a single tensor), with cls and eos the input length is len(seq)+2
+    longest = max(len(seq) for seq in seqs)
+    input_ids = np.full((len(seqs), longest + 2), pad_id, dtype=np.int64)
+    input_ids[:, 0] = cls_id
+    for i, seq in enumerate(seqs):
+        # Non ASCII characters are replaced by '?' and hence by <unk>
+        ids = lut[np.frombuffer(seq.encode('ascii', errors='replace'), dtype=np.uint8)]
+        input_ids[i, 1:len(ids) + 1] = ids
+        input_ids[i, len(ids) + 1] = eos_id
+    attention_masks = (input_ids == pad_id).astype(np.int64)
+
+    return {'input_ids': torch.from_numpy(input_ids),
+            'attention_mask': torch.from_numpy(attention_masks)}
+
 class SaProtTokenizer:
     def __init__(self):
         self.cls_token = '<cls>'
@@ -114,12 +143,11 @@ class SequenceTokenizer:
         self.cls_id = self.token2id[self.cls_token]
         self.mask_id = self.token2id[self.mask_token]
         self.eos_id = self.token2id[self.eos_token]
+        self.lut = build_lut(seq_vocab, self.token2id, self.unk_id)
 
     def __call__(self, aa_seqs,
                  max_len=1024,
-                 truncation=True,
-                 padding=True,
-                 return_tensors='pt'):
+                 truncation=True):
 
         if isinstance(aa_seqs, str):
             aa_seqs = [aa_seqs]
@@ -129,35 +157,9 @@ class SequenceTokenizer:
             raise ValueError('aa_seqs must be either a single\
                               sequence or a list of sequences')
 
-        input_ids = []
-        attention_masks = []
-        longest = min(int(max(len(s) for s in aa_seqs)), max_len)
-        
-        for seq in aa_seqs:
-            seq = list(seq)
-
-            # Replace unknown amino acids with <unk> token
-            seq = [aa if aa in seq_vocab else self.unk_token for aa in seq]
-            
-            # Truncation startegy for max_length (not longest)
-            if truncation and len(seq) > max_len: 
-                seq = seq[:max_len]
-            
-            seq = [self.cls_token] + seq + [self.eos_token]
-
-            # Padding strategy longest
-            # with cls and eos the input length is len(seq)+2
-            if padding and len(seq) < longest + 2:
-                seq = seq + [self.pad_token] * (longest - len(seq) + 2)
-            
-            input_id = [self.token2id[token] for token in seq]
-            input_ids.append(input_id)
-            attention_mask = [0 if token != self.pad_token else 1 for token in seq]
-            attention_masks.append(attention_mask)
-        input_ids_tensor = torch.tensor(input_ids)
-        attention_masks_tensor = torch.tensor(attention_masks)
-        
-        return {'input_ids':input_ids_tensor, 'attention_mask':attention_masks_tensor}
+        return encode_seqs(aa_seqs, self.lut,
+                           self.cls_id, self.eos_id, self.pad_id,
+                           max_len=max_len, truncation=truncation)
 
     def extract_aa_seq(self, pdb_path, chain_id='A'): 
         with open(pdb_path, 'r') as pdb_file:
@@ -194,13 +196,11 @@ class FoldSeekTokenizer:
         self.cls_id = self.token2id[self.cls_token]
         self.mask_id = self.token2id[self.mask_token]
         self.eos_id = self.token2id[self.eos_token]
-
+        self.lut = build_lut(foldseek_struc_vocab, self.token2id, self.unk_id)
 
     def __call__(self, struc_seqs,
                  max_len=1024,
-                 truncation=True,
-                 padding=True,
-                 return_tensors='pt'):
+                 truncation=True):
  
         if isinstance(struc_seqs, str):
             struc_seqs = [struc_seqs]
@@ -210,37 +210,9 @@ class FoldSeekTokenizer:
             raise ValueError('struc_seqs must be either a single\
                               sequence or a list of sequences')
         
-        input_ids = []
-        attention_masks = []
-        
-        longest = min(int(max(len(s) for s in struc_seqs)), max_len)
-        
-        for seq in struc_seqs:
-            seq = list(seq)
-
-            # Replace unknown amino acids with <unk> token
-            seq = [struc if struc in foldseek_struc_vocab else self.unk_token for struc in seq]
-
-            # Truncation startegy for max_length (not longest)
-            if truncation and len(seq) > max_len: 
-                seq = seq[:max_len]
-            
-            seq = [self.cls_token] + seq + [self.eos_token]
-            
-            # Padding strategy longest
-            # with cls and eos the input length is len(seq)+2
-            if padding and len(seq) < longest + 2:
-                seq = seq + [self.pad_token] * (longest - len(seq) + 2)
-
-            input_id = [self.token2id[token] for token in seq]
-            input_ids.append(input_id)
-            attention_mask = [0 if token != self.pad_token else 1 for token in seq]
-            attention_masks.append(attention_mask)
-
-        input_ids_tensor = torch.tensor(input_ids)
-        attention_masks_tensor = torch.tensor(attention_masks)
-        
-        return {'input_ids':input_ids_tensor, 'attention_mask':attention_masks_tensor}
+        return encode_seqs(struc_seqs, self.lut,
+                           self.cls_id, self.eos_id, self.pad_id,
+                           max_len=max_len, truncation=truncation)
 
 
 if __name__ == "__main__":
@@ -3,7 +3,6 @@ import torch.nn as nn
 from torch.utils.data import DataLoader, Dataset, random_split
 import torch.optim as optim
 from torchinfo import summary
-import torch.distributed as dist
 import torchvision
 from torchview import draw_graph
 from torch.optim.lr_scheduler import StepLR
@@ -13,13 +12,16 @@ import random
 import json
 import glob
 import wandb
+from joblib import Memory, Parallel, delayed
 import numpy as np
 import sys
-from sklearn.metrics import precision_score, recall_score, f1_score, accuracy_score
+from torchmetrics import MetricCollection
+from torchmetrics.classification import MulticlassPrecision, MulticlassRecall, MulticlassF1Score, MulticlassAccuracy
 import time
+from contextlib import nullcontext
 from model import TransformerModel
 from utils.timer import Timer
-from utils.foldseek import get_struc_seq
+from utils.foldseek import get_struc_seq_by_checksum, get_pdb_checksum
 from utils.earlystopping import EarlyStopping
 from tokenizer import SequenceTokenizer, FoldSeekTokenizer
 from dataset import SeqsDataset, prepare_data
@@ -37,7 +39,7 @@ def train_model(model,
                 tokenizer_struc_seqs,
                 fabric,
                 masking_ratio,
-                epsilon,
+                accumulation_steps=1,
                 device='cuda',
                 verbose=0):
     """
@@ -49,24 +51,37 @@ def train_model(model,
         optimizer (...): ...
         criterion (...): ...
         epochs (int): Number of epochs
+        accumulation_steps (int): Number of batches to accumulate gradients
+                                  over before each optimizer step
         device (...): ...
         verbose (int): ...
     """
     model.train()
-    total_loss = 0.0
+    # Losses are accumulated on the device to avoid a sync on every batch
+    total_loss = torch.zeros((), device=fabric.device)
+    # Same for the NaN check of the logits, it is only read before each
+    # optimizer step
+    nan_logits = torch.zeros((), dtype=torch.bool, device=fabric.device)
+    optimizer.zero_grad()
 
     for i, batch in enumerate(train_loader):
 
         if verbose > 0 and fabric.is_global_zero:
             print(f"\tT.Batch {i+1} of {len(train_loader)} with size {batch['encoder_input_ids'].shape[0]}")
 
-        encoder_input_ids = fabric.to_device(batch['encoder_input_ids'])
-        encoder_attention_mask = fabric.to_device(batch['encoder_attention_mask'])
-        decoder_input_ids = fabric.to_device(batch['decoder_input_ids'])
-        decoder_attention_mask = fabric.to_device(batch['decoder_attention_mask'])
-        labels = fabric.to_device(batch['labels'])
-    
-        optimizer.zero_grad()
+        encoder_input_ids = batch['encoder_input_ids'].to(fabric.device, non_blocking=True)
+        encoder_attention_mask = batch['encoder_attention_mask'].to(fabric.device, non_blocking=True)
+        decoder_input_ids = batch['decoder_input_ids'].to(fabric.device, non_blocking=True)
+        decoder_attention_mask = batch['decoder_attention_mask'].to(fabric.device, non_blocking=True)
+        # CrossEntropyLoss expects int64 targets
+        labels = batch['labels'].to(fabric.device, non_blocking=True).long()
+
+        # Gradients are only synchronized between GPUs on the last
+        # accumulated batch (or the last batch of the epoch)
+        is_boundary = (i + 1) % accumulation_steps == 0 or (i + 1) == len(train_loader)
+        # The last window of the epoch may hold fewer batches
+        window_start = (i // accumulation_steps) * accumulation_steps
+        window_size = min(accumulation_steps, len(train_loader) - window_start)
 
         # Forward pass through the model
         logits = model(encoder_input=encoder_input_ids,
@@ -74,36 +89,40 @@ def train_model(model,
                        encoder_padding_mask=encoder_attention_mask,
                        decoder_padding_mask=decoder_attention_mask)
         
-        if logits.isnan().any().item():
-            raise ValueError('NaN values in logits')
-
-        # Flatten logits first two dimensions (concatenate seqs from batch)
-        logits = logits.contiguous().view(-1, logits.size(-1))
-        # Normalizing the logits
-        # Adding an epsilon value to the logits in order to avoid divergence
-        # logits = logits / (torch.max(logits, dim=-1, keepdim=True)[0] + epsilon)
+        nan_logits |= logits.isnan().any()
 
-        # Flatten masked_labels dimensions (concatenate seqs from batch)
-        labels = labels.contiguous().view(-1)
-
-        # Compute batch loss
-        loss = criterion(logits, labels)
+        # Compute batch loss, CrossEntropyLoss takes the classes in dim 1
+        # so logits are transposed to (batch, vocab, seq_len) instead of
+        # flattening logits and labels
+        loss = criterion(logits.transpose(1, 2), labels)
 
         # Backward pass and optimization
-        fabric.backward(loss)
-        optimizer.step()
-
-        total_loss += loss.item()
-
-        if verbose > 0:
+        ctx = nullcontext() if is_boundary else fabric.no_backward_sync(model)
+        with ctx:
+            fabric.backward(loss / window_size)
+        if is_boundary:
+            # Stop before updating the weights with NaN gradients (checked on
+            # all GPUs together so they all stop at the same point)
+            if fabric.all_reduce(nan_logits.float(), reduce_op='sum').item() > 0:
+                raise ValueError('NaN values in logits')
+            optimizer.step()
+            optimizer.zero_grad()
+
+        total_loss += loss.detach()
+
+        if verbose > 1:
             print(f"\tTraining Average Batch Loss in cuda:{fabric.global_rank}: {loss.item():.4f}")
 
-        fabric.barrier()
+        # Only wait for the other GPUs when their batch losses are printed
+        if verbose > 1:
+            fabric.barrier()
         if verbose > 0 and fabric.is_global_zero:
             print("----------------------")
 
     gpu_avg_loss = total_loss / len(train_loader)
-    avg_loss = fabric.all_reduce(gpu_avg_loss)
+    # all_reduce works in place, keep the local average untouched
+    avg_loss = fabric.all_reduce(gpu_avg_loss.clone())
+    gpu_avg_loss = gpu_avg_loss.item()
     print(f"Training Average Loss between Batches in cuda:{fabric.global_rank}: {gpu_avg_loss:.4f}")
     
     fabric.barrier()
@@ -121,7 +140,6 @@ def evaluate_model(model,
                    tokenizer_struc_seqs,
                    fabric,
                    masking_ratio,
-                   epsilon,
                    device='cuda',
                    verbose=0):
     """
@@ -129,12 +147,14 @@ def evaluate_model(model,
     logits processing.
     """
     model.eval()
-    total_loss = 0.0
+    # Losses are accumulated on the device to avoid a sync on every batch
+    total_loss = torch.zeros((), device=fabric.device)
     total_correct = 0
     total_samples = 0
 
-    all_preds = []
-    all_labels = []
+    # Metrics are updated on the device for every batch
+    num_classes = tokenizer_struc_seqs.vocab_size
+    metrics = get_metrics(num_classes).to(fabric.device)
 
     with torch.no_grad():
         for i, batch in enumerate(test_loader):
@@ -142,9 +162,10 @@ def evaluate_model(model,
             if verbose > 0 and fabric.is_global_zero:
                 print(f"\tE.Batch {i+1} of {len(test_loader)} with size {batch['encoder_input_ids'].shape[0]}")
 
-            encoder_input_ids = fabric.to_device(batch['encoder_input_ids'])
-            encoder_attention_mask = fabric.to_device(batch['encoder_attention_mask'])
-            labels = fabric.to_device(batch['labels'])
+            encoder_input_ids = batch['encoder_input_ids'].to(fabric.device, non_blocking=True)
+            encoder_attention_mask = batch['encoder_attention_mask'].to(fabric.device, non_blocking=True)
+            # CrossEntropyLoss expects int64 targets
+            labels = batch['labels'].to(fabric.device, non_blocking=True).long()
 
             cls_id = tokenizer_struc_seqs.cls_id
             pad_id = tokenizer_struc_seqs.pad_id
@@ -178,70 +199,43 @@ def evaluate_model(model,
             
             # Concatenate the list of predictions
             predicted = torch.cat(predicted, dim=1)  # shape: (batch_size, trg_len)
-            logits = logits.view(-1, logits.shape[-1])  # Flatten the output for loss calculation
-            labels = labels.contiguous().view(-1)  # Flatten the target
-            loss = criterion(logits, labels)
-            total_loss += loss.item()
-            predicted = predicted.contiguous().view(-1)
+            loss = criterion(logits.transpose(1, 2), labels)  # classes in dim 1
+            total_loss += loss
 
-            # Append predictions and labels for F1 calculation
-            all_labels.append(labels)
-            all_preds.append(predicted)
+            # Update the metrics with the batch predictions and labels
+            metrics.update(predicted, labels)
 
-            if verbose > 0:
+            if verbose > 1:
                 print(f"\tEvaluation Average Batch Loss in cuda:{fabric.global_rank}: {loss.item():.4f}")
             
-            fabric.barrier()
+            # Only wait for the other GPUs when their batch losses are printed
+            if verbose > 1:
+                fabric.barrier()
             if verbose > 0 and fabric.is_global_zero:
                 print("----------------------")
 
-    all_labels = torch.cat(all_labels)
-    all_preds = torch.cat(all_preds)
-
-    gather_labels = all_gather(all_labels)
-    gather_labels = torch.cat(gather_labels)
-    gather_labels = gather_labels.cpu().numpy()
-    gather_preds = all_gather(all_preds)
-    gather_preds = torch.cat(gather_preds)
-    gather_preds = gather_preds.cpu().numpy()
-
-    all_labels = all_labels.cpu().numpy()
-    all_preds = all_preds.cpu().numpy()
-
-    # Compute F1 score, precision, and recall using sklearn
-    gpu_precision = precision_score(all_labels,
-                                    all_preds,
-                                    average='macro',
-                                    zero_division=0)
-    gpu_recall = recall_score(all_labels,
-                              all_preds,
-                              average='macro',
-                              zero_division=0)
-    gpu_f1 = f1_score(all_labels,
-                      all_preds,
-                      average='macro',
-                      zero_division=0)
-    gpu_accuracy = accuracy_score(all_labels,
-                                  all_preds)
-    
-    # Compute F1 score, precision, and recall using sklearn
-    precision = precision_score(gather_labels,
-                                gather_preds,
-                                average='macro',
-                                zero_division=0)
-    recall = recall_score(gather_labels,
-                          gather_preds,
-                          average='macro',
-                          zero_division=0)
-    f1 = f1_score(gather_labels,
-                  gather_preds,
-                  average='macro',
-                  zero_division=0)
-    accuracy = accuracy_score(gather_labels,
-                              gather_preds)
+    # The gpu_* metrics only use this process data, the others are computed
+    # on a copy of the metric states synchronized between GPUs (compute
+    # results are cached, so the same metrics can not be computed twice)
+    global_metrics = metrics.clone()
+    gpu_metrics = {name: value.item() for name, value in metrics.compute().items()}
+    metrics = {}
+    for name, metric in global_metrics.items():
+        with metric.sync_context():
+            metrics[name] = metric.compute().item()
+    gpu_precision = gpu_metrics['precision']
+    gpu_recall = gpu_metrics['recall']
+    gpu_f1 = gpu_metrics['f1_score']
+    gpu_accuracy = gpu_metrics['accuracy']
+    precision = metrics['precision']
+    recall = metrics['recall']
+    f1 = metrics['f1_score']
+    accuracy = metrics['accuracy']
 
     gpu_avg_loss = total_loss / len(test_loader)
-    avg_loss = fabric.all_reduce(gpu_avg_loss)
+    # all_reduce works in place, keep the local average untouched
+    avg_loss = fabric.all_reduce(gpu_avg_loss.clone())
+    gpu_avg_loss = gpu_avg_loss.item()
     
     print(f"Evaluation Average Loss between Batches in cuda:{fabric.global_rank}: {gpu_avg_loss:.4f}")
     fabric.barrier()
@@ -279,25 +273,21 @@ def evaluate_model(model,
             "precision": precision, "recall": recall,
             "accuracy": accuracy, "f1_score": f1}
 
-def all_gather(ten):
-    world_size = dist.get_world_size()
-    local_size = torch.tensor(ten.size(), device=ten.device)
-    all_sizes = [torch.zeros_like(local_size) for _ in range(world_size)]
-    dist.all_gather(all_sizes, local_size)
-    max_length = max(size[0] for size in all_sizes)
-
-    length_diff = max_length.item() - local_size[0].item()
-    if length_diff:
-        pad_size = (length_diff, *ten.size()[1:])
-        padding = torch.zeros(pad_size, device=ten.device, dtype=ten.dtype)
-        ten = torch.cat((ten, padding))
-
-    all_tensors_padded = [torch.zeros_like(ten) for _ in range(world_size)]
-    dist.all_gather(all_tensors_padded, ten)
-    all_tensors = []
-    for tensor_, size in zip(all_tensors_padded, all_sizes):
-        all_tensors.append(tensor_[:size[0]])
-    return all_tensors
+def get_metrics(num_classes):
+    """
+    Classification metrics of the predicted structural tokens, macro
+    averaged except for the accuracy (computed over all the tokens).
+    They are not synchronized between GPUs on compute (see evaluate_model)
+    and inputs are not validated as it syncs with the host on every update
+    (predictions and labels are always valid token ids).
+    """
+    kwargs = {'ignore_index': -100,
+              'sync_on_compute': False,
+              'validate_args': False}
+    return MetricCollection({'precision': MulticlassPrecision(num_classes, average='macro', **kwargs),
+                             'recall': MulticlassRecall(num_classes, average='macro', **kwargs),
+                             'f1_score': MulticlassF1Score(num_classes, average='macro', **kwargs),
+                             'accuracy': MulticlassAccuracy(num_classes, average='micro', **kwargs)})
 
 def draw_model_graph(model,
                      encoder_tokenizer,
@@ -340,11 +330,13 @@ def main(confile, dformat):
     # Initialize Fabric parallelization
     num_gpus = config['num_gpus']
     parallel_strategy = config['parallel_strategy']
+    precision = config['precision']
     fabric = Fabric(accelerator='cuda',
                     devices=num_gpus,
                     num_nodes=1,
                     strategy=parallel_strategy,
-                    precision="bf16-mixed")
+                    precision=precision)
+    fabric.launch()
 
     # Get the data from foldseek calculations from a directory of pdbs
     if dformat == 'pdb':
@@ -354,17 +346,32 @@ def main(confile, dformat):
 
         # Get protein sequence and structural sequence (FoldSeeq) from raw data
         foldseek_path = config["foldseek_path"]
-        raw_data = [get_struc_seq(foldseek_path, pdb) for pdb in pdbs]
-        aa_seqs = []
-        struc_seqs = []
-        for pdb in raw_data:
-            for chain in pdb.keys():
-                aa_seq = pdb[chain][0]
-                struc_seq = pdb[chain][1]
-                common_char, count = Counter(struc_seq).most_common(1)[0]
-                if (count / len(struc_seq)) <= 0.9 and len(aa_seq) > 30:
-                    aa_seqs.append(aa_seq)
-                    struc_seqs.append(struc_seq)
+        # Only rank 0 runs FoldSeek (in parallel and cached on disk between
+        # runs); the filtered sequences are then broadcasted to the other ranks
+        seqs = None
+        if fabric.global_rank == 0:
+            memory = Memory(location='.foldseek_cache', verbose=0)
+            # The cache is keyed by the pdb content (checksum), not only its path
+            cached_get_struc_seq = memory.cache(get_struc_seq_by_checksum,
+                                                ignore=['process_id'])
+            raw_data = Parallel(n_jobs=-1, return_as='generator')(delayed(cached_get_struc_seq)(foldseek_path,
+                                                                                                pdb,
+                                                                                                get_pdb_checksum(pdb),
+                                                                                                process_id=i)
+                                                                  for i, pdb in enumerate(pdbs))
+            # Filter the sequences in the same pass as FoldSeek results arrive
+            aa_seqs = []
+            struc_seqs = []
+            for pdb in raw_data:
+                for chain in pdb.keys():
+                    aa_seq = pdb[chain][0]
+                    struc_seq = pdb[chain][1]
+                    common_char, count = Counter(struc_seq).most_common(1)[0]
+                    if (count / len(struc_seq)) <= 0.9 and len(aa_seq) > 30:
+                        aa_seqs.append(aa_seq)
+                        struc_seqs.append(struc_seq)
+            seqs = (aa_seqs, struc_seqs)
+        aa_seqs, struc_seqs = fabric.broadcast(seqs, src=0)
     # Get the precalculated data from the csv files
     elif dformat == 'csv':
         csv = config['data_as_csv']
@@ -377,38 +384,45 @@ def main(confile, dformat):
     if verbose > 0 and fabric.is_global_zero:
         print('- Total amount of structres given %d' %len(aa_seqs))
 
-    # Load Dataset
-    tokenizer_aa_seqs = SequenceTokenizer()
-    tokenizer_struc_seqs = FoldSeekTokenizer()
-    dataset = SeqsDataset(aa_seqs, struc_seqs)
-    
-    fabric.launch()
-
     test_split = config["test_split"]
     masking_ratio = config['masking_ratio']
     batch_size = config['batch_size']
     max_len = config['max_len']
 
+    # Load Dataset
+    tokenizer_aa_seqs = SequenceTokenizer()
+    tokenizer_struc_seqs = FoldSeekTokenizer()
+    dataset = SeqsDataset(aa_seqs, struc_seqs,
+                          tokenizer_aa_seqs,
+                          tokenizer_struc_seqs,
+                          max_len=max_len)
+
     # Split Dataset into training and testing
     train_loader, test_loader = prepare_data(dataset,test_split,
                                              masking_ratio, batch_size,
-                                             tokenizer_aa_seqs, 
                                              tokenizer_struc_seqs,
-                                             fabric, max_len, verbose)
+                                             fabric, verbose)
     
-    train_loader, test_loader = fabric.setup_dataloaders(train_loader,
-                                                         test_loader)
+    # Batches are moved to the device in the training/evaluation loops
+    # with non_blocking copies from pinned memory. The train sampler is
+    # already distributed (see LengthBucketSampler)
+    train_loader = fabric.setup_dataloaders(train_loader,
+                                            move_to_device=False,
+                                            use_distributed_sampler=False)
+    test_loader = fabric.setup_dataloaders(test_loader,
+                                           move_to_device=False)
 
     # Get model hyperparamaters
     epochs = config['epochs']
     learning_rate = config['learning_rate']
     weight_decay=config['weight_decay']
-    epsilon = config["epsilon"]
+    accumulation_steps = config['accumulation_steps']
     dim_model = config['dim_model']
     num_heads = config['num_heads']
     num_layers = config['num_layers']
     ff_hidden_layer = config['ff_hidden_layer']
     dropout = config['dropout']
+    remove_padding = config['remove_padding']
     
     # Initialize model, optimizer, and loss function
     model = TransformerModel(input_dim=tokenizer_aa_seqs.vocab_size,
@@ -419,8 +433,24 @@ def main(confile, dformat):
                              num_layers=num_layers,
                              ff_hidden_layer=ff_hidden_layer,
                              dropout=dropout,
-                             verbose=verbose)#.to('cuda')
-     
+                             verbose=verbose,
+                             remove_padding=remove_padding)#.to('cuda')
+
+    # Compile the model for kernel fusion, Fabric expects the model to be
+    # compiled before setup so the compiled module is wrapped by DDP
+    # Sequence lengths vary between batches, so dynamic shapes are left
+    # to the compiler instead of recompiling for every length
+    # Off by default: the first epochs pay for recompiles and autotuning,
+    # and evaluation calls encoder_block/decoder_block directly, which
+    # bypasses the compiled forward
+    compile_model = config['compile_model']
+    if compile_model and remove_padding and fabric.is_global_zero:
+        print('- Warning: remove_padding selects the non padding tokens with '
+              'nonzero, which breaks the compiled graph once per forward')
+    if compile_model:
+        torch.set_float32_matmul_precision('high')
+        model = torch.compile(model, mode='max-autotune')
+
     model = fabric.setup_module(model)
 
     draw_model = config['draw_model']
@@ -444,8 +474,10 @@ def main(confile, dformat):
     if verbose > 0 and fabric.is_global_zero:
         summary(model)
 
+    # Model parameters are already on the GPU, use the fused CUDA kernel
     optimizer = optim.Adam(model.parameters(), lr=learning_rate,
-                           weight_decay=weight_decay)
+                           weight_decay=weight_decay,
+                           fused=True)
     scheduler = StepLR(optimizer, step_size=2, gamma=0.1)
     criterion = nn.CrossEntropyLoss(ignore_index=-100, reduction='mean')
    
@@ -459,10 +491,11 @@ def main(confile, dformat):
                                    delta=delta,
                                    verbose=verbose)
 
-    # Initialize wandb 
-    _group = "swiss_DDP_" + wandb.util.generate_id()
-    group = fabric.broadcast(_group, src=0)
+    # Initialize wandb once for the whole training (one run per GPU,
+    # all of them in the same group)
     if config['get_wandb']:
+        _group = "swiss_DDP_" + wandb.util.generate_id()
+        group = fabric.broadcast(_group, src=0)
         wandb.init(project=config["wandb_project"],
                    group=group,
                    name=f"GPU{fabric.global_rank}",
@@ -499,7 +532,7 @@ def main(confile, dformat):
                                        tokenizer_struc_seqs,
                                        fabric,
                                        masking_ratio=masking_ratio,
-                                       epsilon=epsilon,
+                                       accumulation_steps=accumulation_steps,
                                        device='cuda',
                                        verbose=verbose)
         
@@ -517,7 +550,6 @@ def main(confile, dformat):
                                             tokenizer_struc_seqs,
                                             fabric,
                                             masking_ratio=masking_ratio,
-                                            epsilon=epsilon,
                                             device='cuda',
                                             verbose=verbose)
         if fabric.is_global_zero:
@@ -1,6 +1,7 @@
 # Script based on SaProt/utils/foldseek_util.py from https://github.com/SaProt/SaProt
 
 import os
+import hashlib
 
 def get_struc_seq(foldseek,
                   pdb,
@@ -45,3 +46,36 @@ def get_struc_seq(foldseek,
     
     return struc_seq_dict
 
+
+
+def get_pdb_checksum(pdb) -> str:
+    """
+    Args:
+        pdb: Path to pdb file
+
+    Returns:
+        checksum: sha256 hex digest of the pdb file content
+    """
+    sha256 = hashlib.sha256()
+    with open(pdb, "rb") as r:
+        for chunk in iter(lambda: r.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_struc_seq_by_checksum(foldseek,
+                              pdb,
+                              checksum: str,
+                              chains: list = None,
+                              process_id: int = 0) -> dict:
+    """
+    Same as get_struc_seq but taking the pdb checksum as an extra argument,
+    so results cached on disk are invalidated when the pdb content changes.
+
+    Args:
+        checksum: Checksum of the pdb file (see get_pdb_checksum). It is not
+                  used here, it is only part of the cache key.
+    """
+    return get_struc_seq(foldseek, pdb,
+                         chains=chains,
+                         process_id=process_id)